@@ -1,25 +1,46 @@
 import argparse
+import functools
 import os
 import sys
 import re
 import gzip
+import io
+import hashlib
+import shutil
+import subprocess
+from array import array
+from email.utils import formatdate, parsedate_to_datetime
+from http.client import HTTPException, IncompleteRead
 from tempfile import gettempdir
-from urllib import request
+from urllib import parse, request
+from urllib.error import URLError
 
-import yed
+READ_BUFFER_SIZE = 16 * 1024 # размер буфера чтения Packages.gz
+STANZA_BLOCK_SIZE = 256 * 1024 # сколько символов Packages разбирать за раз
+
+# Регулярные выражения компилируются один раз при импорте
+_HOST_RE = re.compile( # хост[:порт] из непустых меток, без возвратов
+	r"^[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?"
+	r"(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?)*"
+	r"(?::\d+)?$")
+_URL_SCHEMES = ("http", "https", "ftp", "ftps")
+_DEP_SEPARATORS = str.maketrans(",|", "  ")
+_DEP_PREFIXES = ("Pre-Depends:", "Depends:") # в порядке полей Debian
 
 def error(msg): # Вывод ошибки
 	print(f"Ошибка: {msg}", file=sys.stderr)
 	sys.exit(2)
 
 
-def is_valid_url(url: str): # Проверка URL
-	regex_pattern = re.compile(
-		r"^(?:http|ftp)s?://"
-		r"(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?$)"
-		r"(?::\d+)?"
-		r"(?:/?|[/?]\S+)$", re.IGNORECASE)
-	return re.match(regex_pattern, url) is not None
+@functools.lru_cache(maxsize=1024) # повторные проверки того же URL берутся из кэша
+def is_valid_url(url: str) -> bool: # Проверка URL
+	if any(c.isspace() for c in url):
+		return False
+	try:
+		parts = parse.urlparse(url)
+	except ValueError: # например, незакрытый IPv6-адрес
+		return False
+	return parts.scheme in _URL_SCHEMES and _HOST_RE.match(parts.netloc) is not None
 
 
 def parse_args(argv=None): # Парсин аргументов
@@ -118,55 +139,221 @@ def print_config(args): # Вывод в формате ключ=значение
 			print(f"{k}={v!s}")
 
 
-def parse_repo_url(url): #parse url repo
+def fetch_packages_gz(url): # download Packages.gz into the temp dir, reuse the copy while it is unchanged
+	name = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+	cache_path = os.path.join(gettempdir(), f"Packages-{name}.gz") # отдельный файл для каждого репозитория
+	cached = os.path.exists(cache_path)
+	req = request.Request(url + "/Packages.gz")
+	if cached:
+		req.add_header("If-Modified-Since", formatdate(os.path.getmtime(cache_path), usegmt=True))
+	tmp_path = cache_path + ".part"
 	try:
-		request.urlretrieve(url + "/Packages.gz", gettempdir() + "\\Packages.gz")
-		with gzip.open(gettempdir() + "\\Packages.gz", "rt", encoding="utf-8") as f:
-			return f.read()
+		try:
+			with request.urlopen(req) as resp:
+				with open(tmp_path, "wb") as f:
+					shutil.copyfileobj(resp, f, READ_BUFFER_SIZE)
+					size = f.tell()
+				# у ответов FTP и file:// нет .length, сверяем с заголовком Content-Length
+				expected = resp.headers.get("Content-Length", "")
+				if expected.isdigit() and size < int(expected): # соединение оборвалось раньше
+					raise IncompleteRead(b"", int(expected) - size)
+				modified = resp.headers.get("Last-Modified")
+		except (URLError, OSError, HTTPException):
+			# 304 Not Modified или сбой сети: берем сохраненную копию
+			if not cached:
+				raise
+			return cache_path
+		os.replace(tmp_path, cache_path)
+	finally:
+		if os.path.exists(tmp_path): # недокачанный файл не оставляем
+			os.remove(tmp_path)
+	if modified: # время файла = время изменения на сервере
+		try:
+			mtime = parsedate_to_datetime(modified).timestamp()
+			os.utime(cache_path, (mtime, mtime))
+		except (TypeError, ValueError, OSError): # заголовок не разобрать: оставляем локальное время
+			pass
+	return cache_path
+
+
+class GunzipStream(io.TextIOWrapper): # text stream read from a `gzip -dc` child process
+	def __init__(self, proc):
+		super().__init__(proc.stdout, encoding="utf-8")
+		self.proc = proc
+
+	def read(self, size=-1):
+		data = super().read(size)
+		if not data or size is None or size < 0: # дочитали до конца: проверяем код выхода gzip
+			if self.proc.wait() != 0: # архив поврежден
+				raise ValueError("Invalid repo")
+		return data
+
+	def close(self):
+		if self.closed:
+			return
+		super().close()
+		if self.proc.poll() is None: # чтение прервано до конца, процесс больше не нужен
+			self.proc.kill()
+		self.proc.wait()
+
+
+def open_gzip_text(path): # decompress with system gzip if available, else with the gzip module
+	try:
+		proc = subprocess.Popen(["gzip", "-dc", path], stdout=subprocess.PIPE,
+			stderr=subprocess.DEVNULL, bufsize=READ_BUFFER_SIZE)
+		return GunzipStream(proc)
+	except OSError: # gzip не установлен
+		raw = gzip.open(path, "rb")
+		buf = io.BufferedReader(raw, buffer_size=READ_BUFFER_SIZE) # читаем крупными блоками
+		return io.TextIOWrapper(buf, encoding="utf-8")
+
+
+def parse_repo_url(url): #parse url repo, returns text stream
+	try:
+		return open_gzip_text(fetch_packages_gz(url))
 	except Exception:
 		raise ValueError("Invalid repo")
 
 
-def parse_path_repo(path): #parse path repo
+def parse_path_repo(path): #parse path repo, returns text stream
 	try:
-		with open(path, "rt", encoding="utf-8") as f:
-			return f.read()
+		return open(path, "rt", encoding="utf-8")
 	except Exception:
 		raise ValueError("Invalid repo")
 
 
-def load_packages(text): # load packs from package file
-	packages = {}
-	for line in text.split("\n"):
-		if line.startswith('Package:'):
-			name = line.split()[1]
-			packages[name] = set()
-		elif re.match(r'(Pre-|)Depends:', line):
-			deps = re.sub(r'(Pre-|)Depends:|:any|,|\||\([^,]+\)', ' ', line)
-			packages[name] |= set(deps.split())
-	return packages
+def parse_depends(rhs): # names from the right side of a Depends line
+	out = []
+	pos = 0
+	while True: # убираем ограничения версий в скобках
+		start = rhs.find("(", pos)
+		if start < 0:
+			out.append(rhs[pos:])
+			break
+		out.append(rhs[pos:start])
+		end = rhs.find(")", start)
+		if end < 0:
+			break
+		pos = end + 1
+	s = " ".join(out).replace(":any", " ").translate(_DEP_SEPARATORS)
+	return s.split()
+
+
+def iter_stanzas(stream): # split Packages into stanzas (blank-line separated), reading in blocks
+	tail = ""
+	while True:
+		block = stream.read(STANZA_BLOCK_SIZE)
+		if not block:
+			break
+		parts = (tail + block).split("\n\n")
+		tail = parts.pop() # последний кусок может быть неполным
+		yield from parts
+	if tail:
+		yield tail
+
+
+def stanza_line(stanza, key): # whole "key..." line of the stanza or None
+	if stanza.startswith(key):
+		start = 0
+	else:
+		start = stanza.find("\n" + key)
+		if start < 0:
+			return None
+		start += 1
+	end = stanza.find("\n", start)
+	return stanza[start:] if end < 0 else stanza[start:end]
+
+
+class PackageIndex: # packages interned to integer ids, dependencies stored CSR-style
+	def __init__(self, names, ids, described, offsets, targets):
+		self.names = names # id -> имя пакета
+		self.ids = ids # имя пакета -> id
+		self.described = described # 1, если у пакета есть своя запись в Packages
+		self.offsets = offsets # зависимости пакета i: targets[offsets[i]:offsets[i + 1]]
+		self.targets = targets
+
+	def __contains__(self, name):
+		i = self.ids.get(name)
+		return i is not None and self.described[i] == 1
+
+	def deps(self, i): # ids of direct dependencies of package i
+		return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+
+def load_packages(stream): # load packs from package file, stanza by stanza
+	names = []
+	ids = {}
+	described = bytearray()
+	edges = [] # id -> список id зависимостей, пока файл читается
+
+	def intern(name):
+		i = ids.get(name)
+		if i is None:
+			i = ids[name] = len(names)
+			names.append(name)
+			described.append(0)
+			edges.append([])
+		return i
+
+	for stanza in iter_stanzas(stream):
+		line = stanza_line(stanza, "Package:")
+		name = line[8:].strip() if line else None # 8 = len("Package:")
+		if not name:
+			continue
+		i = intern(name)
+		described[i] = 1
+		existing = edges[i] = []
+		seen_local = set() # зависимости храним списком без повторов
+		for key in _DEP_PREFIXES:
+			line = stanza_line(stanza, key)
+			if line is None:
+				continue
+			_, _, rhs = line.partition(":")
+			for dep in parse_depends(rhs):
+				d = intern(dep)
+				if d not in seen_local:
+					seen_local.add(d)
+					existing.append(d)
+
+	# упаковываем списки в два сплошных массива
+	offsets = array("i", [0])
+	targets = array("i")
+	for lst in edges:
+		targets.extend(lst)
+		offsets.append(len(targets))
+	return PackageIndex(names, ids, described, offsets, targets)
 
 
 def make_graph(root, packages, dep, fl): # create dependations graph
-	def dfs(name, depth = dep, flt = fl):
-		if depth:
-			graph[name] = set()
-			for dep in packages.get(name, set()):
-				if flt not in dep:
-					if dep not in graph:
-						dfs(dep, depth - 1)
-					if dep in seen:
-						graph[name].add(dep)
-			seen.add(name)
+	# Обход в глубину на явном стеке: кадр = (пакет, оставшаяся глубина, итератор зависимостей)
+	if not dep:
+		return {}
+	r = packages.ids[root] # main проверяет, что пакет есть в индексе
+	names = packages.names
+	seen = set() # полностью обойденные пакеты, ребра ведут только в них (без циклов)
+	graph = {r: []}
+	stack = [(r, dep, iter(packages.deps(r)))]
+	while stack:
+		u, depth, deps = stack[-1]
+		for d in deps:
+			if fl and fl in names[d]:
+				continue
+			if d not in graph and depth > 1:
+				graph[d] = []
+				stack.append((d, depth - 1, iter(packages.deps(d))))
+				break
+			if d in seen:
+				graph[u].append(d)
 		else:
-			return
-	seen = set()
-	graph = {}
-	dfs(root)
-	return graph
+			stack.pop()
+			seen.add(u)
+			if stack:
+				graph[stack[-1][0]].append(u)
+	return {names[u]: [names[v] for v in vs] for u, vs in graph.items()}
 
 
 def viz(graph, path): # yED generator(not used)
+	import yed # импорт только при визуализации
 	y = yed.Graph()
 	nodes = {}
 	for name in graph:
@@ -177,50 +364,54 @@ def viz(graph, path): # yED generator(not used)
 	y.save(f'{path}.graphml')
 
 
-def print_ascii_tree(graph, root, prefix=""): # ascii tree generator
-	print(prefix + root)
-	for dep in graph.get(root, []):
-		print_ascii_tree(graph, dep, prefix + "  ├─ ")
-
-
-d = ["@startwbs"]
-def graph_to_plantuml(graph, root, prefix="*"): # Uml generator
-	global d
-	d += [prefix + " " + root]
-	for dep in graph.get(root, []):
-		graph_to_plantuml(graph, dep, prefix + "*")
+def graph_to_text(graph, root, ascii_tree=False): # Uml and ascii tree generator, one walk for both
+	uml = ["@startwbs"]
+	tree = []
+	stack = [(root, 1)]
+	while stack:
+		name, level = stack.pop()
+		uml.append("*" * level + " " + name)
+		if ascii_tree:
+			tree.append("  ├─ " * (level - 1) + name)
+		for dep in reversed(graph.get(name, ())): # в стек в обратном порядке, чтобы сохранить порядок вывода
+			stack.append((dep, level + 1))
+	uml.append("@endwbs")
+	return uml, tree
 
 def main(argv=None):
 	try:
-		global d
 		args = parse_args(argv)
 		validate_args(args)
 		if not args.repo_path:
 			pars = parse_repo_url(args.repo_url)
 		else:
 			pars = parse_path_repo(args.repo_path)
-		packs = load_packages(pars)
+		with pars:
+			packs = load_packages(pars)
 		if args.package in packs:
 			graph = make_graph(args.package, packs, args.max_depth, args.filter_substr)
 			#stage 4
 			mas = []
 			stage = 5
 			if stage == 4:
+				seen = set()
 				for i in reversed(graph):
 					for j in graph[i]:
-						if j not in mas:
-							mas += [j]
+						if j not in seen:
+							seen.add(j)
+							mas.append(j)
 				print("\n".join(mas))
 
 			# planetUML http://editor.plantuml.com/
+			uml, tree = graph_to_text(graph, args.package, args.ascii_tree == "on")
+			uml_text = "\n".join(uml) + "\n"
 			with open("grph.txt", 'w') as f:
-				graph_to_plantuml(graph, args.package)
-				d += ["@endwbs"]
-				f.write("\n".join(d))
-				print("\n".join(d) + "\n")
+				f.write(uml_text)
+			out = uml_text + "\n"
 			# ascii-tree
-			if args.ascii_tree == "on":
-				print_ascii_tree(graph, args.package)
+			if tree:
+				out += "\n".join(tree) + "\n"
+			sys.stdout.write(out) # весь вывод одной записью
 		else:
 			print("Пакет отсутствует")
 	except SystemExit as e:
@@ -232,4 +423,5 @@ def main(argv=None):
 	except Exception as exc:
 		error(exc)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+	main()